@@ -4,7 +4,7 @@ import numpy as np
 
 def get_videos(subject, session):
     video_idx = np.loadtxt(
-        "data/liris/order_fmri_neuromod.csv", delimiter=",", skiprows=1, dtype=np.int
+        "data/liris/order_fmri_neuromod.csv", delimiter=",", skiprows=1, dtype=int
     )
     selected_idx = video_idx[video_idx[:, 0] == session, subject + 1]
     return selected_idx
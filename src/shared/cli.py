@@ -19,7 +19,8 @@ from ..tasks import task_base, video
 
 
 def listen_shortcuts():
-    if any([k[1] & event.MOD_CTRL for k in event._keyBuffer]):
+    # called every frame: only peek at the pending keys, without draining them
+    if any(k[1] & event.MOD_CTRL for k in event._keyBuffer):
         allKeys = event.getKeys(["n", "c", "q"], modifiers=True)
         ctrl_pressed = any([k[1]["ctrl"] for k in allKeys])
         all_keys_only = [k[0] for k in allKeys]
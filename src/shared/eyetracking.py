@@ -1,5 +1,6 @@
 import os, sys, datetime, time
 import threading
+from array import array
 
 from .zmq_tools import *
 import msgpack
@@ -33,14 +34,44 @@ MARKER_POSITIONS = np.asarray(
         (0.75, 0.5),
     ]
 )
+# marker radius shrinks then grows back, same animation for all markers
+RADIUS_ANIM = np.hstack(
+    [
+        np.linspace(MARKER_SIZE, 0, MARKER_DURATION_FRAMES // 2),
+        np.linspace(0, MARKER_SIZE, MARKER_DURATION_FRAMES // 2),
+    ]
+)
 
 
+# calibration reference sample, converted to pupil's dict format when sent
+REF_DT = np.dtype(
+    [("norm_pos", "f8", 2), ("screen_pos", "f8", 2), ("timestamp", "f8")]
+)
+
 # number of frames to eliminate at start and end of marker
 CALIBRATION_LEAD_IN = 20
 CALIBRATION_LEAD_OUT = 20
 
+# generator used to shuffle marker order
+_rng = np.random.default_rng()
+
 # Pupil settings
 PUPIL_REMOTE_PORT = 50123
+# bound the pupil/gaze backlog on the subscriber side (~100ms at 250Hz) so that
+# a lagging listener drops samples instead of serving stale ones.
+# ZMQ_CONFLATE would keep only the latest message but does not support the
+# multipart (topic, payload) messages sent by pupil, hence a small HWM.
+# It cannot be 1 as the calibration collects all pupils through the listener.
+PUPIL_SUB_HWM = 50
+# max time (ms) the listener waits for messages before checking for a stop request
+LISTENER_POLL_TIMEOUT = 50
+# notifications sent to pupil: faster msgspec encoder if installed, same msgpack output
+try:
+    import msgspec
+
+    _msgpack_encode = msgspec.msgpack.Encoder().encode
+except ImportError:
+    _msgpack_encode = msgpack.dumps
 CAPTURE_SETTINGS = {
     "frame_size": [640, 480],
     "frame_rate": 250,
@@ -52,6 +83,86 @@ CAPTURE_SETTINGS = {
 }
 
 
+class _PupilSamples:
+    """Struct of arrays of the pupil datum fields kept for calibration.
+
+    Appended from the eyetracker listener thread, much lighter than keeping
+    each full pupil dict received from pupil. The 3d model fields (sphere,
+    circle_3d, ...) are not kept: they are in the pupil recording.
+    """
+
+    def __init__(self):
+        self.timestamp = array("d")
+        self.confidence = array("d")
+        self.diameter = array("d")
+        self.norm_pos = array("d")  # interleaved x,y
+        self.ellipse_center = array("d")  # interleaved x,y
+        self.ellipse_axes = array("d")  # interleaved
+        self.ellipse_angle = array("d")
+        self.eye_id = array("b")
+        # (topic, method) pairs are few: store a code per sample
+        self._source_codes = {}
+        self.source = array("B")
+
+    def append(self, pupil):
+        self.timestamp.append(pupil["timestamp"])
+        self.confidence.append(pupil["confidence"])
+        self.diameter.append(pupil["diameter"])
+        self.norm_pos.extend(pupil["norm_pos"])
+        ellipse = pupil["ellipse"]
+        self.ellipse_center.extend(ellipse["center"])
+        self.ellipse_axes.extend(ellipse["axes"])
+        self.ellipse_angle.append(ellipse["angle"])
+        self.eye_id.append(pupil["id"])
+        source = (pupil["topic"], pupil["method"])
+        # last to be appended: its length is the number of complete samples
+        self.source.append(
+            self._source_codes.setdefault(source, len(self._source_codes))
+        )
+
+    def __len__(self):
+        return len(self.source)
+
+    def to_arrays(self):
+        """Copy all fields to numpy arrays, trimmed to the complete samples."""
+        n = len(self)
+        sources = list(self._source_codes)
+        source = self.source[:n]
+        return {
+            "id": np.array(self.eye_id[:n]),
+            "topic": np.array([sources[code][0] for code in source], dtype=str),
+            "method": np.array([sources[code][1] for code in source], dtype=str),
+            "timestamp": np.array(self.timestamp[:n]),
+            "confidence": np.array(self.confidence[:n]),
+            "diameter": np.array(self.diameter[:n]),
+            "norm_pos": np.reshape(self.norm_pos[: 2 * n], (-1, 2)),
+            "ellipse_center": np.reshape(self.ellipse_center[: 2 * n], (-1, 2)),
+            "ellipse_axes": np.reshape(self.ellipse_axes[: 2 * n], (-1, 2)),
+            "ellipse_angle": np.array(self.ellipse_angle[:n]),
+        }
+
+    def to_list(self):
+        """Build the list of pupil dicts expected by pupil calibration."""
+        columns = {field: column.tolist() for field, column in self.to_arrays().items()}
+        return [
+            {
+                "topic": columns["topic"][i],
+                "method": columns["method"][i],
+                "id": columns["id"][i],
+                "timestamp": columns["timestamp"][i],
+                "confidence": columns["confidence"][i],
+                "diameter": columns["diameter"][i],
+                "norm_pos": columns["norm_pos"][i],
+                "ellipse": {
+                    "center": columns["ellipse_center"][i],
+                    "axes": columns["ellipse_axes"][i],
+                    "angle": columns["ellipse_angle"][i],
+                },
+            }
+            for i in range(len(columns["id"]))
+        ]
+
+
 class EyetrackerCalibration(Task):
     def __init__(
         self,
@@ -69,77 +180,87 @@ class EyetrackerCalibration(Task):
         self.eyetracker = eyetracker
 
     def _instructions(self, exp_win, ctl_win):
+        for frameN in range(config.FRAME_RATE * INSTRUCTION_DURATION):
+            self._instruction_stim.draw(exp_win)
+            self._instruction_stim.draw(ctl_win)
+            yield True
+
+    def _setup(self, exp_win):
+        self.use_fmri = False
         instruction_text = """We're going to calibrate the eyetracker.
 Please look at the markers that appear on the screen.
 
 While awaiting for the calibration to start please roll your eyes in one direction then in the other."""
-        screen_text = visual.TextStim(
+        self._instruction_stim = visual.TextStim(
             exp_win,
             text=instruction_text,
             alignText="center",
             color="white",
             wrapWidth=config.WRAP_WIDTH,
         )
-
-        for frameN in range(config.FRAME_RATE * INSTRUCTION_DURATION):
-            screen_text.draw(exp_win)
-            screen_text.draw(ctl_win)
-            yield True
-
-    def _setup(self, exp_win):
-        self.use_fmri = False
+        # reused across markers and recalibrations
+        self._circle_marker = visual.Circle(
+            exp_win,
+            edges=64,
+            units="pixels",
+            lineColor=None,
+            fillColor=self.marker_fill_color,
+            autoLog=False,
+        )
 
     def _pupil_cb(self, pupil):
         if pupil["timestamp"] > self.task_stop:
             self.eyetracker.unset_pupil_cb()
             return
         if pupil["timestamp"] > self.task_start:
-            self._pupils_list.append(pupil)
+            self._pupils.append(pupil)
+
+    def _stamp_ref(self, ref_idx):
+        self._refs["timestamp"][ref_idx] = time.monotonic()  # =pupil frame timestamp on same computer
 
     def _run(self, exp_win, ctl_win):
         calibration_success = False
         while not calibration_success:
             while True:
-                allKeys = event.getKeys([CALIBRATE_HOTKEY])
-                start_calibration = False
-                for key in allKeys:
-                    if key == CALIBRATE_HOTKEY:
-                        start_calibration = True
-                if start_calibration:
+                if event.getKeys([CALIBRATE_HOTKEY]):
                     break
                 yield False
             logging.info("calibration started")
             print("calibration started")
 
-            window_size_frame = exp_win.size - MARKER_SIZE * 2
-            circle_marker = visual.Circle(
-                exp_win,
-                edges=64,
-                units="pixels",
-                lineColor=None,
-                fillColor=self.marker_fill_color,
-                autoLog=False,
-            )
+            # window size does not change during calibration
+            win_size = np.asarray(exp_win.size, dtype=float)
+            half_win_size = win_size / 2
+            window_size_frame = win_size - MARKER_SIZE * 2
+            circle_marker = self._circle_marker
+
+            # marker positions in pixels (centered), screen and normalized coordinates
+            markers_pos = (np.asarray(self.markers) - 0.5) * window_size_frame
+            markers_screen_pos = markers_pos + half_win_size
+            markers_norm_pos = markers_screen_pos / win_size
 
             markers_order = np.arange(len(self.markers))
             if self.markers_order == "random":
-                markers_order = np.random.permutation(markers_order)
+                markers_order = _rng.permutation(markers_order)
 
-            self.all_refs_per_flip = []
-            self._pupils_list = []
+            self._pupils = _PupilSamples()
 
-            radius_anim = np.hstack(
-                [
-                    np.linspace(MARKER_SIZE, 0, MARKER_DURATION_FRAMES // 2),
-                    np.linspace(0, MARKER_SIZE, MARKER_DURATION_FRAMES // 2),
-                ]
-            )
+            radius_anim = RADIUS_ANIM
+
+            # frames of each marker animation used as calibration references
+            lead_in = CALIBRATION_LEAD_IN
+            lead_out = len(radius_anim) - CALIBRATION_LEAD_OUT
+
+            # preallocate one reference sample per flip in the lead-in/out window
+            n_refs_max = len(markers_order) * (lead_out - lead_in - 1)
+            self._refs = refs = np.empty(n_refs_max, dtype=REF_DT)
+            self._n_refs = n_refs = 0
 
             self.task_start = time.monotonic()
             self.task_stop = np.inf
             self.eyetracker.set_pupil_cb(self._pupil_cb)
 
-            while not len(self._pupils_list):  # wait until we get at least a pupil
+            while not len(self._pupils):  # wait until we get at least a pupil
                 yield False
 
             exp_win.logOnFlip(
@@ -148,7 +269,7 @@ While awaiting for the calibration to start please roll your eyes in one directi
             )
             for site_id in markers_order:
                 marker_pos = self.markers[site_id]
-                pos = (marker_pos - 0.5) * window_size_frame
+                pos = markers_pos[site_id]
                 circle_marker.pos = pos
                 exp_win.logOnFlip(
                     level=logging.EXP,
@@ -158,30 +279,28 @@ While awaiting for the calibration to start please roll your eyes in one directi
                 exp_win.callOnFlip(
                     self._log_event, {"marker_x": pos[0], "marker_y": pos[1]}
                 )
+                # reference position is constant while the marker is displayed
+                screen_pos = markers_screen_pos[site_id]
+                norm_pos = markers_norm_pos[site_id]
                 for f, r in enumerate(radius_anim):
                     circle_marker.radius = r
                     circle_marker.draw(exp_win)
                     circle_marker.draw(ctl_win)
 
-                    if (
-                        f > CALIBRATION_LEAD_IN
-                        and f < len(radius_anim) - CALIBRATION_LEAD_OUT
-                    ):
-                        screen_pos = pos + exp_win.size / 2
-                        norm_pos = screen_pos / exp_win.size
-                        ref = {
-                            "norm_pos": norm_pos.tolist(),
-                            "screen_pos": screen_pos.tolist(),
-                            "timestamp": time.monotonic(),  # =pupil frame timestamp on same computer
-                        }
-                        self.all_refs_per_flip.append(ref)  # accumulate all refs
+                    if lead_in < f < lead_out:
+                        # timestamp unknown (NaN) until the flip
+                        refs[n_refs] = (norm_pos, screen_pos, np.nan)
+                        # timestamp the reference when the marker is actually displayed
+                        exp_win.callOnFlip(self._stamp_ref, n_refs)
+                        n_refs += 1
+                        self._n_refs = n_refs
                     yield True
             yield True
             self.task_stop = time.monotonic()
             logging.info(
-                f"calibrating on {len(self._pupils_list)} pupils and {len(self.all_refs_per_flip)} markers"
+                f"calibrating on {len(self._pupils)} pupils and {n_refs} markers"
             )
-            self.eyetracker.calibrate(self._pupils_list, self.all_refs_per_flip)
+            self.eyetracker.calibrate(self._pupils.to_list(), refs[:n_refs])
             while True:
                 notes = getattr(self.eyetracker, '_last_calibration_notification',None)
                 if notes:
@@ -195,10 +314,24 @@ While awaiting for the calibration to start please roll your eyes in one directi
         self.eyetracker.unset_pupil_cb()
         yield
 
+    # calib-data npz layout, one row per sample:
+    #   pupils_{id,topic,method,timestamp,confidence,diameter,norm_pos,
+    #           ellipse_center,ellipse_axes,ellipse_angle}
+    #   markers_{norm_pos,screen_pos,timestamp}
+    # older files instead hold pickled lists of dicts under `pupils` (pupil
+    # datums) and `markers` (references), to be loaded with allow_pickle=True.
     def _save(self):
-        if hasattr(self, "_pupils_list"):
+        if hasattr(self, "_pupils"):
             fname = self._generate_unique_filename("calib-data", "npz")
-            np.savez(fname, pupils=self._pupils_list, markers=self.all_refs_per_flip)
+            refs = self._refs[: self._n_refs]
+            pupils = self._pupils.to_arrays()
+            np.savez_compressed(
+                fname,
+                **{f"pupils_{field}": column for field, column in pupils.items()},
+                markers_norm_pos=refs["norm_pos"],
+                markers_screen_pos=refs["screen_pos"],
+                markers_timestamp=refs["timestamp"],
+            )
 
 
 class EyetrackerTask(Task):
@@ -224,12 +357,7 @@ class EyetrackerTask(Task):
 
     def _run(self, exp_win, ctl_win):
         while True:
-            allKeys = event.getKeys([CALIBRATE_HOTKEY])
-            start_calibration = False
-            for key in allKeys:
-                if key == CALIBRATE_HOTKEY:
-                    start_calibration = True
-            if start_calibration:
+            if event.getKeys([CALIBRATE_HOTKEY]):
                 break
             yield
         print('calibration started')
@@ -241,13 +369,12 @@ class EyetrackerTask(Task):
             lineColor=None,fillColor=self.marker_fill_color,
             autoLog=False)
 
-        random_order = np.random.permutation(np.arange(len(MARKER_POSITIONS))) # not needed I think
+        random_order = _rng.permutation(len(MARKER_POSITIONS)) # not needed I think
 
         all_refs_per_flip = []
         all_pupils = []
 
-        radius_anim = np.hstack([np.linspace(MARKER_SIZE,0,MARKER_DURATION_FRAMES/2),
-                                 np.linspace(0,MARKER_SIZE,MARKER_DURATION_FRAMES/2)])
+        radius_anim = RADIUS_ANIM
 
         exp_win.logOnFlip(level=logging.EXP,msg='eyetracker_calibration: starting at %f'%time.time())
 
@@ -278,18 +405,6 @@ class EyetrackerTask(Task):
 
 from subprocess import Popen
 
-from contextlib import contextmanager
-
-
-@contextmanager
-def nonblocking(lock):
-    locked = lock.acquire(False)
-    try:
-        yield locked
-    finally:
-        if locked:
-            lock.release()
-
 
 class EyeTrackerClient(threading.Thread):
 
@@ -298,7 +413,6 @@ class EyeTrackerClient(threading.Thread):
     def __init__(self, output_path, output_fname_base, profile=False, debug=False):
         super(EyeTrackerClient, self).__init__()
         self.stoprequest = threading.Event()
-        self.lock = threading.Lock()
 
         self.pupil = None
         self.gaze = None
@@ -402,7 +516,7 @@ class EyeTrackerClient(threading.Thread):
     def send_recv_notification(self, n):
         # REQ REP requires lock step communication with multipart msg (topic,msgpack_encoded dict)
         self._req_socket.send_multipart(
-            (bytes("notify.%s" % n["subject"], "utf-8"), msgpack.dumps(n))
+            (bytes("notify.%s" % n["subject"], "utf-8"), _msgpack_encode(n))
         )
         return self._req_socket.recv()
 
@@ -433,7 +547,7 @@ class EyeTrackerClient(threading.Thread):
         self.send_recv_notification({"subject": "launcher_process.should_stop"})
         self._pupil_process.wait(timeout)
         self._pupil_process.terminate()
-        time.sleep(1 / 60.0)
+        # the listener notices the stop request within LISTENER_POLL_TIMEOUT
         super(EyeTrackerClient, self).join(timeout)
 
     def run(self):
@@ -443,24 +557,50 @@ class EyeTrackerClient(threading.Thread):
         logging.info(f"ipc_sub_port: {ipc_sub_port}")
         self.pupil_monitor = Msg_Receiver(
             self._ctx, f"tcp://localhost:{ipc_sub_port}",
-            topics=("gaze", "pupil", "notify.calibration.successful", "notify.calibration.failed")
+            topics=("gaze", "pupil"),
+            hwm=PUPIL_SUB_HWM,
+        )
+        # calibration results must never be dropped: separate socket with default hwm
+        self.notify_monitor = Msg_Receiver(
+            self._ctx, f"tcp://localhost:{ipc_sub_port}",
+            topics=("notify.calibration.successful", "notify.calibration.failed"),
         )
+        poller = zmq.Poller()
+        poller.register(self.pupil_monitor.socket, zmq.POLLIN)
+        poller.register(self.notify_monitor.socket, zmq.POLLIN)
         while not self.stoprequest.isSet():
-            msg = self.pupil_monitor.recv()
-            if not msg is None:
-                topic, tmp = msg
-                with self.lock:
-                    if topic.startswith("pupil"):
-                        self.pupil = tmp
-                        if self._pupil_cb:
-                            self._pupil_cb(tmp)
-                    elif topic.startswith("gaze"):
-                        self.gaze = tmp
-                    elif topic.startswith("notify.calibration"):
-                        self._last_calibration_notification = tmp
-            time.sleep(1e-3)
+            # timeout bounds the latency to notice the stop request
+            events = dict(poller.poll(LISTENER_POLL_TIMEOUT))
+            if self.pupil_monitor.socket in events:
+                self._poll_latest()
+            while self.notify_monitor.new_data:
+                topic, tmp = self.notify_monitor.recv()
+                self._last_calibration_notification = tmp
         logging.info("eyetracker listener: stopping")
 
+    def _poll_latest(self):
+        # receive one message then drain the pending ones before latching,
+        # so that get_pupil/get_gaze return the newest samples in the socket buffer.
+        # the drain is capped to the subscriber queue size so that a listener
+        # that cannot keep up still latches samples and checks for stop/notifications.
+        # sockets are not threadsafe: this must only be called by the listener thread.
+        pupil = gaze = None
+        for _ in range(PUPIL_SUB_HWM):
+            topic, tmp = self.pupil_monitor.recv()
+            if topic.startswith("pupil"):
+                pupil = tmp
+                if self._pupil_cb:
+                    self._pupil_cb(tmp)
+            elif topic.startswith("gaze"):
+                gaze = tmp
+            if not self.pupil_monitor.new_data:
+                break
+        # rebinding an attribute is atomic: readers do not need a lock
+        if pupil is not None:
+            self.pupil = pupil
+        if gaze is not None:
+            self.gaze = gaze
+
     def set_pupil_cb(self, pupil_cb):
         self._pupil_cb = pupil_cb
 
@@ -468,20 +608,21 @@ class EyeTrackerClient(threading.Thread):
         self._pupil_cb = None
 
     def get_pupil(self):
-        with nonblocking(self.lock) as locked:
-            if locked:
-                return self.pupil
+        return self.pupil
 
     def get_gaze(self):
-        with nonblocking(self.lock) as locked:
-            if locked:
-                return self.gaze
+        return self.gaze
 
     def calibrate(self, pupil_list, ref_list):
         if len(pupil_list) < 100:
             logging.error("Calibration: not enough pupil captured for calibration")
             # return
 
+        if isinstance(ref_list, np.ndarray):
+            # structured array (see REF_DT): convert once to the dicts pupil expects
+            fields = ref_list.dtype.names
+            columns = [ref_list[field].tolist() for field in fields]
+            ref_list = [dict(zip(fields, ref)) for ref in zip(*columns)]
         calib_data = {"ref_list": ref_list, "pupil_list": pupil_list}
 
         logging.info("sending calibration data to pupil")
@@ -500,6 +641,7 @@ class GazeDrawer:
     def __init__(self, win):
 
         self.win = win
+        self._half_win_size = (self.win.size[0] / 2, self.win.size[1] / 2)
         self._gazepoint_stim = visual.Circle(
             self.win,
             radius=30,
@@ -513,8 +655,8 @@ class GazeDrawer:
     def draw_gazepoint(self, gaze):
         pos = gaze["norm_pos"]
         self._gazepoint_stim.pos = (
-            int(pos[0] / 2 * self.win.size[0]),
-            int(pos[1] / 2 * self.win.size[1]),
+            int(pos[0] * self._half_win_size[0]),
+            int(pos[1] * self._half_win_size[1]),
         )
         # self._gazepoint_stim.radius = self.pupils['diameter']/2
         # print(self._gazepoint_stim.pos, self._gazepoint_stim.radius)
@@ -522,6 +664,8 @@ class GazeDrawer:
 
 
 def read_pl_data(fname):
+    # pldata files are a stream of concatenated msgpack objects, which msgspec
+    # cannot decode incrementally: always use msgpack streaming unpacker here
     with open(fname, "rb") as fh:
         for data in msgpack.Unpacker(fh, raw=False, use_list=False):
             yield (data)
@@ -57,6 +57,16 @@ class ZMQ_handler(logging.Handler):
             self.socket.send(record_dict)
 
 
+# decoding payloads is the hot path of the receivers:
+# reuse a single msgspec decoder if installed, same result as msgpack
+try:
+    import msgspec
+
+    _msgpack_decode = msgspec.msgpack.Decoder().decode
+except ImportError:
+    _msgpack_decode = serializer.loads
+
+
 class ZMQ_Socket(object):
     def __del__(self):
         self.socket.close()
@@ -123,7 +133,7 @@ class Msg_Receiver(ZMQ_Socket):
             yield self.socket.recv()
 
     def deserialize_payload(self, payload_serialized, *extra_frames):
-        payload = serializer.loads(payload_serialized)
+        payload = _msgpack_decode(payload_serialized)
         if extra_frames:
             payload["__raw_data__"] = extra_frames
         return payload
@@ -21,6 +21,9 @@ DIREC_POS = np.asarray([((0,0.5),(1,0.5)), # left
                         ((0.5,1),(0.5,0))]) # down # [direction][start/end][x/y]
 DIREC_VECTOR = DIRECTIONS * REPETITIONS
 
+# generator used to shuffle trial order
+_rng = np.random.default_rng()
+
 
 class EyetrackerTask(Task):
 
@@ -45,12 +48,7 @@ class EyetrackerTask(Task):
 
     def _run(self, exp_win, ctl_win):
         while True:
-            allKeys = event.getKeys([CALIBRATE_HOTKEY])
-            start_calibration = False
-            for key in allKeys:
-                if key == CALIBRATE_HOTKEY:
-                    start_calibration = True
-            if start_calibration:
+            if event.getKeys([CALIBRATE_HOTKEY]):
                 break
             yield
         window_size_frame = exp_win.size-MARKER_SIZE*2
@@ -61,15 +59,15 @@ class EyetrackerTask(Task):
             lineColor=None,fillColor=self.marker_fill_color,
             autoLog=False)
 
-        random_order = np.random.permutation(np.arange(len(DIREC_VECTOR)))
-        random_order_SP = np.random.permutation(np.arange(len(DIREC_VECTOR)))
+        random_order = _rng.permutation(len(DIREC_VECTOR))
+        random_order_SP = _rng.permutation(len(DIREC_VECTOR))
 
 
         all_refs_per_flip = []
         all_pupils = []
 
-        radius_anim = np.hstack([np.linspace(MARKER_SIZE,0,MARKER_DURATION_FRAMES/2),
-                                 np.linspace(0,MARKER_SIZE,MARKER_DURATION_FRAMES/2)])
+        radius_anim = np.hstack([np.linspace(MARKER_SIZE,0,MARKER_DURATION_FRAMES//2),
+                                 np.linspace(0,MARKER_SIZE,MARKER_DURATION_FRAMES//2)])
 
         exp_win.logOnFlip(level=logging.EXP,msg='eyetracker_calibration: starting at %f'%time.time())
         # Run saccades
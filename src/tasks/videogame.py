@@ -58,7 +58,7 @@ class SoundDeviceBlockStream(sound.backend_sounddevice.SoundDeviceSound):
         if self.status == constants.STOPPED:
             return
         if self.blocks.empty():
-            block = np.zeros((self.blockSize, 2), dtype=np.float)
+            block = np.zeros((self.blockSize, 2), dtype=float)
         else:
             with self.lock:
                 block = self.blocks.get()